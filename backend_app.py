@@ -3,50 +3,78 @@
 # Se encarga de cargar los documentos, crear la base de datos vectorial,
 # y responder a las preguntas utilizando el framework RAG (Retrieval Augmented Generation).
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request
 from langchain_ollama import ChatOllama
 from langchain_ollama import OllamaEmbeddings
 from langchain_community.vectorstores import Chroma
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_core.prompts import ChatPromptTemplate
-from langchain.chains import RetrievalQA
+from langchain_core.messages import SystemMessage, HumanMessage
 from langchain_core.documents import Document
 import os
-import shutil
+import json
+import orjson
+import hashlib
+import uuid
+import time
+import functools
+import threading
+import chromadb
+import numpy as np
+from filelock import FileLock
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 
 app = Flask(__name__)
 
 # --- 1. Preparación de Documentos Técnicos ---
 DATA_DIR = "./documents" # Directorio donde se guardarán los archivos de texto (manuales, normas, etc.)
 
-def load_documents_from_files(directory):
+# Número máximo de archivos que se leen en paralelo.
+LOAD_MAX_WORKERS = 8
+
+def _load_document(directory, filename):
+    """
+    Lee un archivo de texto y lo convierte en un objeto Document de Langchain.
+    Devuelve None si el archivo no se pudo leer.
+    """
+    filepath = os.path.join(directory, filename)
+    try:
+        with open(filepath, "r", encoding="utf-8") as f:
+            content = f.read()
+        # Creamos un objeto Document con el contenido y el nombre del archivo como fuente
+        return Document(page_content=content, metadata={"source": filename})
+    except Exception as e:
+        print(f"Error al cargar el archivo {filename}: {e}")
+        return None
+
+def load_documents_from_files(directory, filenames=None):
     """
     Carga documentos de archivos de texto (.txt) desde un directorio dado.
     Cada archivo se convierte en un objeto Document de Langchain.
+    Si se indica `filenames`, solo se cargan esos archivos (por ejemplo, los que cambiaron
+    desde la última indexación), evitando leer y dividir documentos ya indexados.
+    Los archivos se leen en paralelo con hilos: la lectura de disco libera el GIL.
     """
-    loaded_documents = []
-    if not os.path.exists(directory):
-        print(f"ADVERTENCIA: El directorio de datos '{directory}' no existe. Creando uno vacío.")
-        os.makedirs(directory)
-
-    for filename in os.listdir(directory):
-        if filename.endswith(".txt"):
-            filepath = os.path.join(directory, filename)
-            try:
-                with open(filepath, "r", encoding="utf-8") as f:
-                    content = f.read()
-                # Creamos un objeto Document con el contenido y el nombre del archivo como fuente
-                loaded_documents.append(Document(page_content=content, metadata={"source": filename}))
-                print(f"Cargado: {filename}")
-            except Exception as e:
-                print(f"Error al cargar el archivo {filename}: {e}")
+    pending_files = [
+        filename for filename in os.listdir(directory)
+        if filename.endswith(".txt") and (filenames is None or filename in filenames)
+    ]
+    if not pending_files:
+        return []
+    with ThreadPoolExecutor(max_workers=min(LOAD_MAX_WORKERS, len(pending_files))) as executor:
+        results = executor.map(functools.partial(_load_document, directory), pending_files)
+    loaded_documents = [doc for doc in results if doc is not None]
+    for doc in loaded_documents:
+        print(f"Cargado: {doc.metadata['source']}")
     return loaded_documents
 
-# Cargar los documentos desde los archivos de texto
-docs_with_metadata = load_documents_from_files(DATA_DIR)
+if not os.path.exists(DATA_DIR):
+    print(f"ADVERTENCIA: El directorio de datos '{DATA_DIR}' no existe. Creando uno vacío.")
+    os.makedirs(DATA_DIR)
 
-# Si no se cargaron documentos
-if not docs_with_metadata:
+# Si no hay documentos. Los archivos se cargan más adelante, solo si necesitan indexarse.
+if not any(filename.endswith(".txt") for filename in os.listdir(DATA_DIR)):
     print(f"ERROR: No se encontraron archivos .txt en el directorio '{DATA_DIR}'.")
     print("Por favor, coloca al menos un archivo .txt con contenido en esta carpeta (ej. en la carpeta './data/').")
     exit(1)
@@ -57,7 +85,24 @@ if not docs_with_metadata:
 # chunk_overlap: cantidad de texto superpuesto entre fragmentos consecutivos para mantener el contexto.
 text_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=50)
 
-all_splits = text_splitter.split_documents(docs_with_metadata) # Ahora se pasa la lista de objetos Document
+class ParallelOllamaEmbeddings(OllamaEmbeddings):
+    """
+    OllamaEmbeddings que reparte los textos en lotes de `batch_size` y los envía de forma concurrente.
+    Cada lote se embebe en una sola petición a `/api/embed` (que acepta una lista de textos),
+    amortizando el costo HTTP por petición; y como generar embeddings está limitado por la
+    latencia de esas peticiones (no por la CPU local), varios lotes se envían a la vez.
+    """
+    batch_size: int = 64
+    max_workers: int = 8
+
+    def embed_documents(self, texts):
+        # Lotes contiguos para conservar el orden de los resultados.
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        if len(batches) <= 1:
+            return super().embed_documents(texts)
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(batches))) as executor:
+            results = executor.map(super().embed_documents, batches)
+        return [vector for batch in results for vector in batch]
 
 # Inicializar el modelo de embeddings de Ollama.
 # Este modelo convierte el texto en vectores numéricos (embeddings).
@@ -65,7 +110,7 @@ all_splits = text_splitter.split_documents(docs_with_metadata) # Ahora se pasa l
 # por ejemplo, 'nomic-embed-text'. Puedes descargarlo con `ollama pull nomic-embed-text`.
 print("Inicializando OllamaEmbeddings (requiere 'nomic-embed-text')...")
 try:
-    embeddings = OllamaEmbeddings(model="nomic-embed-text") # Modelo recomendado para embeddings
+    embeddings = ParallelOllamaEmbeddings(model="nomic-embed-text", batch_size=64, max_workers=8) # Modelo recomendado para embeddings
     print("OllamaEmbeddings inicializado.")
 except Exception as e:
     print(f"Error al inicializar OllamaEmbeddings: {e}")
@@ -73,36 +118,345 @@ except Exception as e:
     print("Ejecuta `ollama serve` y luego `ollama pull nomic-embed-text` en tu terminal.")
     exit(1) # Salir si no se pueden inicializar los embeddings
 
-# Crear la base de datos vectorial local con ChromaDB.
-# ChromaDB es una base de datos vectorial ligera que se puede usar localmente.
-# Se indexan los fragmentos de documentos con sus embeddings.
-print("Creando base de datos vectorial ChromaDB y indexando documentos...")
 # Directorio para almacenar la base de datos Chroma
 persist_directory = "./chroma_db"
+# Si se define CHROMA_HOST, el backend se conecta a un servidor de Chroma independiente
+# (por ejemplo, `chroma run --path ./chroma_db --port 8000`) en lugar de abrir la base de datos
+# dentro del proceso. Así los workers no bloquean el GIL con las escrituras de SQLite y del
+# índice HNSW, y varias instancias del backend comparten el mismo índice.
+CHROMA_HOST = os.getenv("CHROMA_HOST")
+CHROMA_PORT = int(os.getenv("CHROMA_PORT", "8000"))
+# Manifiesto del índice activo: nombre de la colección de Chroma que lo contiene y huella de
+# cada archivo indexado. Permite saber qué documentos cambiaron y reutilizar los embeddings del resto.
+# Se guarda en los metadatos de esta colección, para que todas las instancias lo compartan.
+MANIFEST_COLLECTION = "index-manifest"
+# Bloqueo entre procesos: con varios workers de gunicorn solo uno reindexa a la vez,
+# y los demás encuentran el manifiesto ya actualizado.
+INDEX_LOCK_PATH = os.path.join(persist_directory, "index.lock")
+# Cada reindexación crea una colección nueva con este prefijo; la anterior sigue atendiendo
+# preguntas hasta que la nueva está completa.
+COLLECTION_PREFIX = "docs"
+# Cada cuántos segundos se comprueba si los documentos cambiaron.
+INDEX_CHECK_INTERVAL = 60
 
-if os.path.exists(persist_directory):
-    print(f"Intentando eliminar el directorio existente de ChromaDB: {persist_directory}")
+def compute_file_hashes(directory):
+    """
+    Calcula una huella sha256(nombre + mtime + tamaño) para cada archivo .txt del directorio.
+    Es suficiente para detectar archivos nuevos o modificados sin leer su contenido.
+    """
+    file_hashes = {}
+    for filename in os.listdir(directory):
+        if filename.endswith(".txt"):
+            stat = os.stat(os.path.join(directory, filename))
+            fingerprint = f"{filename}{stat.st_mtime}{stat.st_size}".encode("utf-8")
+            file_hashes[filename] = hashlib.sha256(fingerprint).hexdigest()
+    return file_hashes
+
+def _manifest_collection():
+    # Esta colección no guarda fragmentos, solo metadatos, por lo que no necesita función de embeddings.
+    return chroma_client.get_or_create_collection(MANIFEST_COLLECTION, embedding_function=None)
+
+def load_manifest():
+    """
+    Lee el manifiesto del índice activo:
+    {"collection": nombre, "files": {archivo: huella}, "chunks": número de fragmentos}.
+    Si no existe o está corrupto, devuelve un manifiesto sin colección,
+    lo que obliga a reindexar todos los documentos.
+    """
+    empty_manifest = {"collection": None, "files": {}}
+    metadata = _manifest_collection().metadata or {}
+    if "manifest" not in metadata:
+        return empty_manifest
     try:
-        shutil.rmtree(persist_directory)
-        print(f"Directorio '{persist_directory}' eliminado exitosamente.")
-    except PermissionError as e:
-        print(f"Error específico: {e}")
-        exit(1)
+        manifest = json.loads(metadata["manifest"])
     except Exception as e:
-        print(f"ADVERTENCIA: Ocurrió un error inesperado al intentar eliminar el directorio '{persist_directory}': {e}")
-        exit(1)
+        print(f"ADVERTENCIA: No se pudo leer el manifiesto del índice: {e}")
+        return empty_manifest
+    if "collection" not in manifest or "files" not in manifest:
+        return empty_manifest
+    return manifest
 
+def save_manifest(manifest):
+    """
+    Guarda el manifiesto del índice activo. Se reemplaza en una sola operación,
+    por lo que otros procesos nunca leen un manifiesto a medio escribir.
+    """
+    _manifest_collection().modify(metadata={"manifest": json.dumps(manifest, sort_keys=True)})
+
+# Cantidad de fragmentos que se envían a Chroma en cada llamada (Chroma recomienda entre 50 y 250).
+INDEX_BATCH_SIZE = 200
+
+# Fragmentos que se embeben en cada llamada a `embed_documents`: con lotes de 64 textos son 16
+# peticiones, suficientes para ocupar los 8 hilos de ParallelOllamaEmbeddings, sin tener que
+# embeber (y guardar en memoria) todo el corpus antes de empezar a insertar.
+INDEX_EMBED_WINDOW = 5 * INDEX_BATCH_SIZE
+# Máximo de inserciones simultáneas en el servidor de Chroma (y de lotes en memoria esperando turno).
+CHROMA_MAX_CONCURRENT_ADDS = 4
+
+def add_batches(vectorstore, batches):
+    """
+    Inserta en la colección los lotes (ids, embeddings, documents, metadatas) que produce `batches`.
+    Los lotes se consumen a medida que se insertan, de modo que si `batches` es un generador
+    que calcula embeddings, el embebido y la inserción se solapan.
+    Las inserciones se hacen en un grupo de hilos: con un servidor de Chroma se envían hasta
+    CHROMA_MAX_CONCURRENT_ADDS lotes a la vez por el mismo cliente HTTP; con la base de datos
+    local se inserta un lote mientras se prepara el siguiente.
+    """
+    max_pending = CHROMA_MAX_CONCURRENT_ADDS if CHROMA_HOST else 1
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max_pending) as executor:
+        for batch in batches:
+            # Esperar a que termine la inserción más antigua antes de encolar otra.
+            if len(pending) >= max_pending:
+                pending.popleft().result()
+            pending.append(executor.submit(vectorstore._collection.add, **batch))
+        for future in pending:
+            future.result()
+
+def _embedded_batches(splits):
+    """
+    Genera los lotes de inserción de los fragmentos. Los embeddings se calculan por ventanas de
+    INDEX_EMBED_WINDOW fragmentos, cada una en una sola llamada, para que ParallelOllamaEmbeddings
+    reparta el trabajo entre todos sus hilos.
+    """
+    for start in range(0, len(splits), INDEX_EMBED_WINDOW):
+        window = splits[start:start + INDEX_EMBED_WINDOW]
+        texts = [doc.page_content for doc in window]
+        vectors = embeddings.embed_documents(texts)
+        for i in range(0, len(window), INDEX_BATCH_SIZE):
+            yield {
+                "ids": [str(uuid.uuid4()) for _ in texts[i:i + INDEX_BATCH_SIZE]],
+                "embeddings": vectors[i:i + INDEX_BATCH_SIZE],
+                "documents": texts[i:i + INDEX_BATCH_SIZE],
+                "metadatas": [doc.metadata for doc in window[i:i + INDEX_BATCH_SIZE]]
+            }
+
+def index_documents(vectorstore, splits):
+    """
+    Indexa los fragmentos en Chroma por lotes de INDEX_BATCH_SIZE.
+    Los embeddings se calculan por ventanas y se insertan directamente en la colección de Chroma,
+    evitando el procesamiento por documento de Langchain; mientras se inserta una ventana
+    se embebe la siguiente.
+    """
+    add_batches(vectorstore, _embedded_batches(splits))
+
+def _copied_batches(source_vectorstore, filenames):
+    """
+    Genera lotes con los fragmentos (y sus embeddings) de los archivos indicados, leyendo la
+    colección de origen página a página para no cargarla entera en memoria.
+    """
+    offset = 0
+    while True:
+        page = source_vectorstore._collection.get(
+            where={"source": {"$in": list(filenames)}},
+            include=["embeddings", "documents", "metadatas"],
+            limit=INDEX_BATCH_SIZE,
+            offset=offset
+        )
+        if not page["ids"]:
+            return
+        yield {
+            "ids": page["ids"],
+            "embeddings": page["embeddings"],
+            "documents": page["documents"],
+            "metadatas": page["metadatas"]
+        }
+        offset += len(page["ids"])
+
+def copy_documents(source_vectorstore, target_vectorstore, filenames):
+    """
+    Copia a otra colección los fragmentos (con sus embeddings ya calculados) de los archivos
+    indicados, para no tener que volver a generar embeddings de documentos que no cambiaron.
+    """
+    add_batches(target_vectorstore, _copied_batches(source_vectorstore, filenames))
+
+# Los embeddings de 'nomic-embed-text' se comparan por similitud coseno, por lo que el
+# índice HNSW de Chroma se configura con esa métrica en lugar de la distancia L2 por defecto.
+COLLECTION_METADATA = {"hnsw:space": "cosine"}
+
+def open_collection(collection_name):
+    """
+    Abre (o crea, si no existe) una colección de Chroma.
+    """
+    return Chroma(
+        client=chroma_client,
+        collection_name=collection_name,
+        embedding_function=embeddings,
+        collection_metadata=COLLECTION_METADATA
+    )
+
+def open_index():
+    """
+    Abre el índice indicado por el manifiesto y devuelve (vectorstore, manifiesto).
+    Si todavía no hay índice, devuelve (None, manifiesto vacío). Si la colección no tiene los
+    fragmentos que indica el manifiesto (fue borrada o es de una versión anterior sin ese dato)
+    o fue creada con otra métrica (Chroma ignora la métrica al reabrir una colección existente),
+    se sigue usando, pero el manifiesto se devuelve sin archivos para forzar su reconstrucción.
+    Una colección vacía es válida si los documentos no producen fragmentos (archivos vacíos).
+    """
+    manifest = load_manifest()
+    if manifest["collection"] is None:
+        return None, manifest
+    vectorstore = open_collection(manifest["collection"])
+    if (vectorstore._collection.metadata or {}).get("hnsw:space") != COLLECTION_METADATA["hnsw:space"]:
+        print("La colección existente no usa distancia coseno. Se reconstruirá el índice.")
+        return vectorstore, {"collection": manifest["collection"], "files": {}}
+    if vectorstore._collection.count() != manifest.get("chunks"):
+        return vectorstore, {"collection": manifest["collection"], "files": {}}
+    return vectorstore, manifest
+
+def build_index(current_hashes, base_vectorstore, base_manifest):
+    """
+    Construye el índice de los documentos actuales en una colección nueva.
+    Los fragmentos de archivos que no cambiaron se copian del índice anterior; solo los archivos
+    nuevos o modificados se leen, se dividen y se embeben. Devuelve (vectorstore, manifiesto).
+    """
+    collection_name = f"{COLLECTION_PREFIX}-{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    vectorstore = open_collection(collection_name)
+
+    previous_hashes = base_manifest["files"]
+    unchanged_files = [name for name, digest in current_hashes.items() if previous_hashes.get(name) == digest]
+    changed_files = [name for name in current_hashes if name not in unchanged_files]
+    removed_files = [name for name in previous_hashes if name not in current_hashes]
+    print(f"Documentos modificados: {changed_files}. Documentos eliminados: {removed_files}.")
+
+    if base_vectorstore is not None and unchanged_files:
+        copy_documents(base_vectorstore, vectorstore, unchanged_files)
+
+    # Indexar únicamente los fragmentos de los archivos nuevos o modificados.
+    changed_docs = load_documents_from_files(DATA_DIR, changed_files)
+    new_splits = text_splitter.split_documents(changed_docs)
+    index_documents(vectorstore, new_splits)
+    print(f"{len(new_splits)} fragmentos indexados en la colección '{collection_name}'.")
+    manifest = {"collection": collection_name, "files": current_hashes, "chunks": vectorstore._collection.count()}
+    return vectorstore, manifest
+
+# Colección por defecto de Langchain, donde versiones anteriores guardaban el índice en ./chroma_db.
+LEGACY_COLLECTION = "langchain"
+
+def is_prunable_collection(name):
+    """
+    Indica si una colección pertenece a un índice de este backend y se puede eliminar.
+    Con un servidor de Chroma solo se tocan colecciones con COLLECTION_PREFIX, ya que puede alojar
+    colecciones de otras aplicaciones; con la base de datos local se elimina también la colección
+    por defecto de versiones anteriores.
+    """
+    if name.startswith(f"{COLLECTION_PREFIX}-"):
+        return True
+    return not CHROMA_HOST and name == LEGACY_COLLECTION
+
+def prune_collections(keep):
+    """
+    Elimina las colecciones de índices antiguos (incluida la colección por defecto de versiones
+    anteriores, en modo local), excepto las indicadas en `keep`. Se conserva también el índice
+    anterior porque otros workers pueden seguir usándolo hasta su siguiente comprobación.
+    """
+    for collection in chroma_client.list_collections():
+        if is_prunable_collection(collection.name) and collection.name not in keep:
+            try:
+                chroma_client.delete_collection(collection.name)
+                print(f"Colección antigua eliminada: {collection.name}")
+            except Exception as e:
+                print(f"ADVERTENCIA: No se pudo eliminar la colección '{collection.name}': {e}")
+
+# El índice activo se comparte entre los hilos que atienden preguntas y el hilo que reindexa.
+# Se lee y se reemplaza siempre bajo este lock, de modo que el cambio de índice es atómico.
+# La generación aumenta con cada cambio de índice: una pregunta que empezó con un índice
+# anterior no guarda su resultado en las cachés (ver `store_answer`).
+_index_lock = threading.Lock()
+_active_vectorstore = None
+_active_manifest = {"collection": None, "files": {}}
+_index_generation = 0
+
+def get_vectorstore():
+    """
+    Devuelve la base de datos vectorial activa, o None si todavía no se ha construido ninguna.
+    """
+    with _index_lock:
+        return _active_vectorstore
+
+def get_active_index():
+    """
+    Devuelve (vectorstore, generación) del índice activo, leídos a la vez.
+    """
+    with _index_lock:
+        return _active_vectorstore, _index_generation
+
+def set_active_index(vectorstore, manifest):
+    """
+    Reemplaza el índice activo y vacía las cachés de respuestas y de recuperación, que pueden
+    depender de documentos que acaban de cambiar. Las cachés se vacían bajo el mismo lock con
+    el que se guardan los resultados, así ninguna respuesta del índice anterior sobrevive al cambio.
+    """
+    global _active_vectorstore, _active_manifest, _index_generation
+    with _index_lock:
+        _active_vectorstore = vectorstore
+        _active_manifest = manifest
+        _index_generation += 1
+        answer_cache.clear()
+        semantic_cache.clear()
+        retrieval_cache.clear()
+
+def rebuild_if_stale():
+    """
+    Comprueba si los documentos cambiaron respecto al manifiesto y, si es así, construye
+    un índice nuevo en segundo plano y lo activa al terminar. Mientras tanto se sigue
+    respondiendo con el índice anterior.
+    """
+    with FileLock(INDEX_LOCK_PATH):
+        current_hashes = compute_file_hashes(DATA_DIR)
+        # Releer el manifiesto: otro worker pudo haber reconstruido el índice mientras tanto.
+        vectorstore, manifest = open_index()
+        if vectorstore is not None and manifest["files"] == current_hashes:
+            if manifest["collection"] != _active_manifest["collection"]:
+                print(f"Usando el índice reconstruido por otro proceso: '{manifest['collection']}'.")
+                set_active_index(vectorstore, manifest)
+            return
+
+        new_vectorstore, new_manifest = build_index(current_hashes, vectorstore, manifest)
+        save_manifest(new_manifest)
+        set_active_index(new_vectorstore, new_manifest)
+        print(f"Índice actualizado. Usando la colección '{new_manifest['collection']}'.")
+        prune_collections(keep={new_manifest["collection"], manifest["collection"]})
+
+def index_maintenance_loop():
+    """
+    Hilo en segundo plano que mantiene el índice sincronizado con los documentos.
+    """
+    while True:
+        try:
+            rebuild_if_stale()
+        except Exception as e:
+            print(f"Error al actualizar el índice de documentos: {e}")
+        time.sleep(INDEX_CHECK_INTERVAL)
+
+# Abrir la base de datos vectorial con ChromaDB.
+# ChromaDB es una base de datos vectorial ligera que se puede usar localmente o como servidor.
+# Se abre el último índice persistido para responder de inmediato; si los documentos cambiaron,
+# el hilo de mantenimiento lo reconstruye en segundo plano (ver más abajo).
+print("Abriendo base de datos vectorial ChromaDB...")
+# El directorio local se usa siempre para el bloqueo entre workers, y para los datos en modo local.
 if not os.path.exists(persist_directory):
     os.makedirs(persist_directory)
 
-vectorstore = Chroma.from_documents(
-    documents=all_splits,
-    embedding=embeddings,
-    persist_directory=persist_directory
-)
-# Persistir la base de datos para que no se reconstruya cada vez que se inicie el servidor
-vectorstore.persist()
-print(f"Base de datos vectorial ChromaDB creada y documentos indexados en '{persist_directory}'.")
+try:
+    if CHROMA_HOST:
+        chroma_client = chromadb.HttpClient(host=CHROMA_HOST, port=CHROMA_PORT)
+        chroma_location = f"el servidor de Chroma en {CHROMA_HOST}:{CHROMA_PORT}"
+    else:
+        chroma_client = chromadb.PersistentClient(path=persist_directory)
+        chroma_location = f"'{persist_directory}'"
+    _active_vectorstore, _active_manifest = open_index()
+except Exception as e:
+    print(f"Error al abrir la base de datos vectorial ChromaDB: {e}")
+    if CHROMA_HOST:
+        print(f"Asegúrate de que el servidor de Chroma esté corriendo: `chroma run --path ./chroma_db --port {CHROMA_PORT}`.")
+    exit(1)
+
+if _active_vectorstore is None:
+    print("Todavía no existe un índice de documentos. Se construirá en segundo plano.")
+else:
+    print(f"Índice de documentos abierto desde {chroma_location} (colección '{_active_manifest['collection']}').")
 
 # --- 3. Implementación del Asistente RAG ---
 # Inicializar el modelo de lenguaje grande (LLM) de Ollama.
@@ -110,8 +464,11 @@ print(f"Base de datos vectorial ChromaDB creada y documentos indexados en '{pers
 # Asegúrate de que Ollama esté corriendo y tengas un modelo LLM descargado,
 # por ejemplo, 'llama3.2' o 'mistral'. Puedes descargarlo con `ollama pull llama3.2`.
 print("Inicializando Ollama LLM (requiere 'llama2' u otro modelo LLM Ollama)...")
+# num_ctx: tamaño de la ventana de contexto; debe ser igual en todas las peticiones para que
+# Ollama no recargue el modelo y pueda reutilizar la caché KV del prefijo común del prompt.
+# keep_alive: mantiene el modelo (y esa caché) cargado en memoria entre preguntas.
 try:
-    llm = ChatOllama(model="llama3.2") # Modelo LLM recomendado
+    llm = ChatOllama(model="llama3.2", num_ctx=4096, keep_alive="30m") # Modelo LLM recomendado
     print("Ollama LLM inicializado.")
 except Exception as e:
     print(f"Error al inicializar Ollama LLM: {e}")
@@ -119,63 +476,448 @@ except Exception as e:
     print("Ejecuta `ollama pull llama3.2` en tu terminal.")
     exit(1) # Salir si no se puede inicializar el LLM
 
-# Crear el recuperador (retriever) de la base de datos vectorial.
-# El retriever es responsable de buscar los documentos más relevantes dada una pregunta.
-retriever = vectorstore.as_retriever(search_kwargs={"k": 5}) # Recuperar los 2 documentos más relevantes
+# Parámetros de recuperación de documentos.
+# Se buscan RETRIEVAL_CANDIDATES fragmentos una sola vez y luego se decide cuántos usar:
+# si el mejor fragmento destaca claramente sobre el quinto (diferencia de similitud mayor que
+# RETRIEVAL_SCORE_GAP), la pregunta es concreta y bastan RETRIEVAL_K_FOCUSED fragmentos;
+# si no, se usan RETRIEVAL_K. Menos fragmentos significa un prompt más corto y una respuesta más rápida.
+RETRIEVAL_CANDIDATES = 10
+RETRIEVAL_K = 5
+RETRIEVAL_K_FOCUSED = 2
+RETRIEVAL_SCORE_GAP = 0.2
+
+def retrieve_documents(vectorstore, generation, question, query_vector):
+    """
+    Recupera los fragmentos más relevantes para la pregunta, ajustando dinámicamente cuántos se usan.
+    Recibe el embedding de la pregunta ya calculado para no volver a pedirlo a Ollama, y reutiliza
+    los fragmentos recuperados para una pregunta parecida si están en la caché.
+    `generation` es la generación del índice `vectorstore`, para no guardar en caché resultados
+    de un índice que ya fue reemplazado.
+    """
+    cached_docs = retrieval_cache.get_similar(query_vector)
+    if cached_docs is not None:
+        print("Documentos de una pregunta similar obtenidos de la caché de recuperación.")
+        return cached_docs
+
+    relevance_score_fn = vectorstore._select_relevance_score_fn()
+    results = vectorstore.similarity_search_by_vector_with_relevance_scores(query_vector, k=RETRIEVAL_CANDIDATES)
+    # Chroma devuelve distancias; se convierten en puntuaciones de relevancia (mayor es mejor).
+    results = [(doc, relevance_score_fn(distance)) for doc, distance in results]
+    k = RETRIEVAL_K
+    if len(results) >= RETRIEVAL_K and results[0][1] - results[RETRIEVAL_K - 1][1] > RETRIEVAL_SCORE_GAP:
+        k = RETRIEVAL_K_FOCUSED
+    docs = [doc for doc, _ in results[:k]]
+    with _index_lock:
+        if generation == _index_generation:
+            retrieval_cache.put(question, query_vector, docs)
+    return docs
+
+# Presupuesto de tokens para el contexto recuperado. El tiempo de procesamiento del prompt (prefill)
+# crece con su longitud, y el prompt completo debe caber en la ventana de contexto (num_ctx) del LLM.
+# Ollama no expone el tokenizador del modelo, así que los tokens se estiman a partir de los caracteres
+# (unos 3 caracteres por token en español es una estimación conservadora).
+MAX_CONTEXT_TOKENS = 2048
+CHARS_PER_TOKEN = 3
+
+def estimate_tokens(text):
+    """
+    Estima de forma conservadora cuántos tokens ocupa un texto.
+    """
+    return len(text) // CHARS_PER_TOKEN + 1
+
+def fit_context_budget(docs):
+    """
+    Recorta la lista de fragmentos (ordenada de más a menos relevante) para que el contexto
+    no supere MAX_CONTEXT_TOKENS. Así los fragmentos más relevantes siempre se conservan.
+    """
+    selected_docs = []
+    context_tokens = 0
+    for doc in docs:
+        doc_tokens = estimate_tokens(doc.page_content)
+        if context_tokens + doc_tokens > MAX_CONTEXT_TOKENS:
+            break
+        selected_docs.append(doc)
+        context_tokens += doc_tokens
+    print(f"Contexto: {len(selected_docs)} de {len(docs)} fragmentos, ~{context_tokens} tokens.")
+    return selected_docs
 
 # Definir un prompt personalizado para el RAG.
 # Este prompt guía al LLM sobre cómo usar el contexto recuperado para responder.
-prompt_template = ChatPromptTemplate.from_template(
+# Las instrucciones van en un mensaje de sistema fijo, idéntico en todas las preguntas, y el contexto
+# recuperado y la pregunta van al final. Así Ollama reutiliza la caché KV del prefijo común
+# y solo tiene que procesar (prefill) la parte variable del prompt.
+SYSTEM_PROMPT = (
+    "Eres un asistente técnico útil y conciso. Utiliza el contexto proporcionado "
+    "para responder a la pregunta. Si no encuentras la respuesta en el contexto, "
+    "simplemente di que no lo sabes. No intentes inventar información."
+)
+
+prompt_template = ChatPromptTemplate.from_messages([
+    ("system", SYSTEM_PROMPT),
+    ("human", "Contexto:\n{context}\n\nPregunta: {question}\nRespuesta:")
+])
+
+def warm_up_llm():
+    """
+    Envía una petición mínima con el prefijo fijo del prompt para que Ollama cargue el modelo
+    y calcule la caché KV del mensaje de sistema antes de la primera pregunta real.
     """
-    Eres un asistente técnico útil y conciso. Utiliza el siguiente contexto proporcionado
-    para responder a la pregunta. Si no encuentras la respuesta en el contexto,
-    simplemente di que no lo sabes. No intentes inventar información.
+    try:
+        warm_up = llm.model_copy(update={"num_predict": 1})
+        warm_up.invoke([SystemMessage(content=SYSTEM_PROMPT), HumanMessage(content="Hola")])
+        print("Modelo LLM precargado con el prefijo del prompt.")
+    except Exception as e:
+        print(f"ADVERTENCIA: No se pudo precargar el modelo LLM: {e}")
 
-    Contexto:
-    {context}
+def prepare_prompt(question, docs):
+    """
+    Construye los mensajes para el LLM a partir de la pregunta y los documentos recuperados.
+    Todos los documentos recuperados se juntan en un solo contexto (equivalente a la cadena 'stuff').
+    Devuelve (mensajes, fuentes) para poder mostrar de dónde vino la información.
+    """
+    docs = fit_context_budget(docs)
+    context = "\n\n".join(doc.page_content for doc in docs)
+    messages = prompt_template.format_messages(context=context, question=question)
+    # Extraer los metadatos de los documentos fuente para mostrar de dónde vino la información.
+    source_documents = tuple(doc.metadata.get('source', 'N/A') for doc in docs)
+    return messages, source_documents
+
+print("Asistente RAG configurado y listo para consultas.")
+
+# --- Caché de respuestas ---
+# Las preguntas repetidas se responden desde memoria, sin volver a ejecutar la recuperación
+# ni la generación del LLM. La caché se vacía cada vez que se reindexan documentos.
+# Tiene la misma capacidad que la caché semántica, para que una pregunta repetida no tenga que
+# calcular su embedding solo porque salió antes de la caché exacta.
+ANSWER_CACHE_SIZE = 4096
 
-    Pregunta: {question}
-    Respuesta:
+# Respuesta cuando el LLM no devuelve texto.
+NO_ANSWER_MESSAGE = "Lo siento, no pude encontrar una respuesta clara en la documentación."
+
+class LRUCache:
+    """
+    Caché LRU segura entre hilos: al llenarse descarta la entrada usada hace más tiempo.
     """
-)
 
-# Crear la cadena RetrievalQA.
-# Esta cadena integra la recuperación de documentos con la generación de respuestas del LLM.
-# 'stuff' chain_type: Junta todos los documentos recuperados en un solo prompt para el LLM.
-# return_source_documents=True: Para mostrar qué documentos se utilizaron para la respuesta.
-qa_chain = RetrievalQA.from_chain_type(
-    llm=llm,
-    chain_type="stuff",
-    retriever=retriever,
-    return_source_documents=True,
-    chain_type_kwargs={"prompt": prompt_template}
-)
-print("Cadena RAG (RetrievalQA) configurada y lista para consultas.")
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get(self, key):
+        """
+        Devuelve el valor guardado para la clave, o None si no está.
+        """
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+# Caché exacta, indexada por la pregunta normalizada. La comparten /ask y /ask_stream,
+# y se consulta antes de calcular el embedding de la pregunta.
+answer_cache = LRUCache(ANSWER_CACHE_SIZE)
+
+# Caché semántica: preguntas formuladas de otra manera pero con el mismo significado
+# (similitud coseno entre sus embeddings mayor que el umbral) reutilizan la misma respuesta.
+SEMANTIC_CACHE_SIZE = 4096
+SEMANTIC_CACHE_THRESHOLD = 0.92
+
+class SemanticCache:
+    """
+    Caché de respuestas indexada por el embedding de la pregunta.
+    Guarda los embeddings normalizados en una matriz que funciona como buffer circular,
+    de modo que buscar una pregunta similar es un único producto matriz-vector.
+    """
+
+    def __init__(self, capacity, threshold):
+        self.capacity = capacity
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._matrix = None # Se reserva al guardar el primer embedding (la dimensión depende del modelo)
+            self._values = [None] * self.capacity
+            self._size = 0
+            self._next = 0
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def get(self, vector):
+        """
+        Devuelve el valor guardado para la pregunta más parecida, o None si ninguna supera el umbral.
+        """
+        query = self._normalize(vector)
+        with self._lock:
+            if self._size == 0:
+                return None
+            scores = self._matrix[:self._size] @ query
+            best = int(np.argmax(scores))
+            if scores[best] <= self.threshold:
+                return None
+            return self._values[best]
+
+    def put(self, vector, value):
+        """
+        Guarda un valor para el embedding dado, reemplazando la entrada más antigua si está llena.
+        """
+        query = self._normalize(vector)
+        with self._lock:
+            if self._matrix is None:
+                self._matrix = np.zeros((self.capacity, query.shape[0]), dtype=np.float32)
+            self._matrix[self._next] = query
+            self._values[self._next] = value
+            self._next = (self._next + 1) % self.capacity
+            self._size = min(self._size + 1, self.capacity)
+
+semantic_cache = SemanticCache(SEMANTIC_CACHE_SIZE, SEMANTIC_CACHE_THRESHOLD)
+
+# Caché de recuperación: guarda los fragmentos recuperados por pregunta (no la respuesta).
+# Se consulta cuando no hay respuesta en caché: el LLM vuelve a generar la respuesta, pero se
+# evita la búsqueda en Chroma. Tiene dos niveles:
+# - exacto, por la pregunta normalizada, antes de calcular el embedding (por ejemplo, si la
+#   generación anterior falló o el cliente cerró el stream antes de terminar);
+# - semántico, para preguntas casi idénticas. Usa un umbral más estricto que la caché de respuestas:
+#   preguntas cortas con la misma estructura ("Dime qué es un ...") tienen embeddings muy parecidos
+#   aunque traten de temas distintos, y reutilizar fragmentos de otro tema daría respuestas equivocadas.
+#   Por eso este nivel es sobre todo un respaldo (por ejemplo, tras una generación fallida).
+RETRIEVAL_CACHE_SIZE = 4096
+RETRIEVAL_CACHE_THRESHOLD = 0.95
+
+class RetrievalCache:
+    """
+    Caché LRU de fragmentos recuperados indexada por la pregunta normalizada, con una
+    caché semántica como respaldo para preguntas casi idénticas.
+    """
+
+    def __init__(self, capacity, threshold):
+        self._exact = LRUCache(capacity)
+        self._semantic = SemanticCache(capacity, threshold)
+
+    def clear(self):
+        self._exact.clear()
+        self._semantic.clear()
+
+    def get(self, question):
+        """
+        Devuelve los fragmentos guardados para la pregunta exacta, o None.
+        """
+        return self._exact.get(question)
+
+    def get_similar(self, vector):
+        """
+        Devuelve los fragmentos guardados para una pregunta parecida, o None.
+        """
+        return self._semantic.get(vector)
+
+    def put(self, question, vector, docs):
+        """
+        Guarda los fragmentos recuperados para la pregunta, descartando la entrada menos usada si está llena.
+        """
+        self._exact.put(question, docs)
+        self._semantic.put(vector, docs)
+
+retrieval_cache = RetrievalCache(RETRIEVAL_CACHE_SIZE, RETRIEVAL_CACHE_THRESHOLD)
+
+def normalize_question(question):
+    """
+    Clave de caché de una pregunta: sin espacios en los extremos y en minúsculas. Solo se usa
+    para buscar en las cachés; al modelo de embeddings y al LLM se les envía la pregunta original,
+    ya que las mayúsculas aportan información (siglas como GPIO o UART, nombres propios).
+    """
+    return question.strip().lower()
+
+def prepare_answer(question):
+    """
+    Busca la respuesta a una pregunta en las cachés y, si no está, construye el prompt.
+    Las cachés se consultan de la más barata a la más cara: respuesta exacta y fragmentos para la
+    pregunta exacta (ambas sin calcular el embedding), respuesta semántica y fragmentos para una
+    pregunta parecida.
+    Devuelve (respuesta_en_caché, mensajes, fuentes, entrada_de_caché): si hay una respuesta
+    (respuesta, fuentes) en caché, el resto de valores es None; si no, la respuesta generada
+    se guarda con `store_answer(entrada_de_caché, ...)`.
+    Las fuentes son una tupla para que el resultado en caché sea inmutable.
+    """
+    key = normalize_question(question)
+    vectorstore, generation = get_active_index()
+    cached = answer_cache.get(key)
+    if cached is not None:
+        print("Respuesta obtenida de la caché.")
+        return cached, None, None, None
+
+    question = question.strip()
+    query_vector = None
+    docs = retrieval_cache.get(key)
+    if docs is not None:
+        print("Documentos obtenidos de la caché de recuperación.")
+    else:
+        query_vector = embeddings.embed_query(question)
+        cached = semantic_cache.get(query_vector)
+        if cached is not None:
+            print("Respuesta obtenida de la caché semántica.")
+            store_answer((key, None, generation), *cached)
+            return cached, None, None, None
+        docs = retrieve_documents(vectorstore, generation, key, query_vector)
+
+    messages, source_documents = prepare_prompt(question, docs)
+    return None, messages, source_documents, (key, query_vector, generation)
+
+def store_answer(cache_entry, answer, source_documents):
+    """
+    Guarda una respuesta en la caché exacta y, si se conoce el embedding de la pregunta, en la semántica.
+    Si el índice cambió mientras se generaba la respuesta, no se guarda: podría depender de
+    documentos que ya no están.
+    """
+    key, query_vector, generation = cache_entry
+    with _index_lock:
+        if generation != _index_generation:
+            return
+        answer_cache.put(key, (answer, source_documents))
+        if query_vector is not None:
+            semantic_cache.put(query_vector, (answer, source_documents))
+
+# Mantener la base de datos vectorial sincronizada con los documentos y precargar el LLM
+# en segundo plano, sin bloquear el arranque del servidor (cargar el modelo puede tardar).
+threading.Thread(target=index_maintenance_loop, daemon=True).start()
+threading.Thread(target=warm_up_llm, daemon=True).start()
 
 # --- Endpoint de la API Flask ---
+# Las respuestas y los cuerpos de las peticiones se (de)serializan con orjson, que es más rápido
+# que el módulo json estándar que usa Flask; importa sobre todo en el streaming, donde se
+# serializa un evento por cada fragmento de texto generado.
+def json_response(payload, status=200):
+    """
+    Construye una respuesta JSON serializada con orjson.
+    """
+    return app.response_class(orjson.dumps(payload), status=status, mimetype="application/json")
+
+def read_json_body():
+    """
+    Lee el cuerpo JSON de la petición. Devuelve un diccionario vacío si el cuerpo
+    no es un objeto JSON válido, de modo que la validación de la pregunta lo rechace.
+    """
+    try:
+        data = orjson.loads(request.get_data())
+    except orjson.JSONDecodeError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+def read_question():
+    """
+    Devuelve la pregunta del cuerpo JSON de la petición, o None si falta, no es un texto
+    o solo contiene espacios (así no se calculan embeddings ni se llama al LLM en vano).
+    """
+    question = read_json_body().get('question')
+    if not isinstance(question, str) or not question.strip():
+        return None
+    return question
+
+# Respuesta mientras se construye el primer índice de documentos.
+INDEX_NOT_READY_MESSAGE = "El índice de documentos se está construyendo. Intenta de nuevo en unos segundos."
+
 # Este endpoint recibe preguntas del frontend y devuelve las respuestas del asistente.
 @app.route('/ask', methods=['POST'])
 def ask():
-    data = request.get_json()
-    question = data.get('question')
+    question = read_question()
 
-    if not question:
-        return jsonify({"error": "Por favor, proporciona una pregunta en el cuerpo de la solicitud."}), 400
+    if question is None:
+        return json_response({"error": "Por favor, proporciona una pregunta en el cuerpo de la solicitud."}, 400)
+
+    if get_vectorstore() is None:
+        return json_response({"error": INDEX_NOT_READY_MESSAGE}, 503)
 
     print(f"Pregunta recibida: '{question}'")
     try:
-        # Invocar la cadena RAG con la pregunta del usuario.
-        result = qa_chain.invoke({"query": question})
-        answer = result.get('result', "Lo siento, no pude encontrar una respuesta clara en la documentación.")
-        # Extraer los metadatos de los documentos fuente para mostrar de dónde vino la información.
-        source_documents = [doc.metadata.get('source', 'N/A') for doc in result.get('source_documents', [])]
+        # Responder la pregunta (o reutilizar la respuesta en caché).
+        cached, messages, source_documents, cache_entry = prepare_answer(question)
+        if cached is not None:
+            answer, source_documents = cached
+        else:
+            response = llm.invoke(messages)
+            answer = response.content or NO_ANSWER_MESSAGE
+            store_answer(cache_entry, answer, source_documents)
+        source_documents = list(source_documents)
 
         print(f"Respuesta generada: {answer}")
         print(f"Documentos fuente utilizados: {source_documents}")
-        return jsonify({"answer": answer, "sources": source_documents})
+        return json_response({"answer": answer, "sources": source_documents})
     except Exception as e:
         print(f"Error al procesar la pregunta: {e}")
-        return jsonify({"error": f"Error interno del servidor al procesar la pregunta: {str(e)}"}), 500
+        return json_response({"error": f"Error interno del servidor al procesar la pregunta: {str(e)}"}, 500)
+
+def sse_event(payload):
+    """
+    Serializa un diccionario como un evento Server-Sent Events.
+    """
+    return f"data: {orjson.dumps(payload).decode('utf-8')}\n\n"
+
+# Este endpoint devuelve la respuesta token a token mediante Server-Sent Events,
+# para que el usuario empiece a leer la respuesta sin esperar a que el LLM termine.
+# Eventos: {"delta": "..."} por cada fragmento de texto, y al final {"sources": [...]}
+# o {"error": "..."} si la generación falla.
+@app.route('/ask_stream', methods=['POST'])
+def ask_stream():
+    question = read_question()
+
+    if question is None:
+        return json_response({"error": "Por favor, proporciona una pregunta en el cuerpo de la solicitud."}, 400)
+
+    if get_vectorstore() is None:
+        return json_response({"error": INDEX_NOT_READY_MESSAGE}, 503)
+
+    print(f"Pregunta recibida (streaming): '{question}'")
+    try:
+        # La recuperación se hace antes de abrir el stream para poder devolver un error HTTP si falla.
+        cached, messages, source_documents, cache_entry = prepare_answer(question)
+    except Exception as e:
+        print(f"Error al procesar la pregunta: {e}")
+        return json_response({"error": f"Error interno del servidor al procesar la pregunta: {str(e)}"}, 500)
+
+    def generate():
+        if cached is not None:
+            answer, sources = cached
+            yield sse_event({"delta": answer})
+            yield sse_event({"sources": list(sources)})
+            return
+
+        try:
+            answer_parts = []
+            for chunk in llm.stream(messages):
+                if chunk.content:
+                    answer_parts.append(chunk.content)
+                    yield sse_event({"delta": chunk.content})
+            answer = "".join(answer_parts)
+            if not answer:
+                answer = NO_ANSWER_MESSAGE
+                yield sse_event({"delta": answer})
+            # Solo se guarda la respuesta completa: si el cliente cierra el stream, no se llega aquí.
+            store_answer(cache_entry, answer, source_documents)
+
+            print(f"Respuesta generada: {answer}")
+            print(f"Documentos fuente utilizados: {list(source_documents)}")
+            yield sse_event({"sources": list(source_documents)})
+        except Exception as e:
+            print(f"Error al generar la respuesta: {e}")
+            yield sse_event({"error": f"Error interno del servidor al generar la respuesta: {str(e)}"})
+
+    return Response(generate(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
 
 # Punto de entrada para ejecutar el servidor Flask.
 if __name__ == '__main__':
@@ -186,5 +928,8 @@ if __name__ == '__main__':
     print("Asegúrate de haber descargado los modelos necesarios:")
     print("  - Para embeddings: `ollama pull nomic-embed-text`")
     print("  - Para el LLM: `ollama pull llama3.2`")
+    print("Para producción (Linux/macOS) usa gunicorn: `gunicorn -c gunicorn.conf.py backend_app:app`")
     print("----------------------------------------------------------------------------------")
-    app.run(debug=True, port=5000, use_reloader=False)
+    # Servidor de desarrollo de Flask. El modo debug solo se activa con la variable FLASK_DEV.
+    # threaded=True permite atender varias preguntas a la vez mientras se espera a Ollama.
+    app.run(debug=bool(os.getenv("FLASK_DEV")), port=5000, use_reloader=False, threaded=True)
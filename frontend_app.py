@@ -4,6 +4,7 @@
 
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
 import json
 
 # --- Configuración de la página Streamlit ---
@@ -13,6 +14,28 @@ st.set_page_config(
     layout="centered"
 )
 
+# --- Sesión HTTP compartida con el backend ---
+# Reutilizar la misma sesión mantiene abiertas las conexiones (keep-alive) con el backend
+# y evita abrir una conexión TCP nueva por cada pregunta.
+@st.cache_resource
+def get_session():
+    session = requests.Session()
+    session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=1))
+    return session
+
+def backend_error_message(response):
+    """
+    Devuelve el mensaje de error que el backend envía en el cuerpo JSON de una respuesta no exitosa
+    (por ejemplo, el 503 mientras se construye el índice). Si el cuerpo no es JSON, lanza el error HTTP.
+    """
+    try:
+        message = response.json().get("error")
+    except ValueError:
+        message = None
+    if not message:
+        response.raise_for_status()
+    return message
+
 # --- Título y descripción de la aplicación ---
 st.title("🤖 Asistente Técnico Inteligente")
 st.markdown(
@@ -45,24 +68,43 @@ if prompt := st.chat_input("Escribe tu pregunta aquí..."):
     with st.chat_message("user"):
         st.markdown(prompt)
 
-    # Preparar y enviar la pregunta al backend de Flask
+    # Preparar y enviar la pregunta al backend de Flask.
+    # La respuesta llega por Server-Sent Events y se muestra a medida que el LLM la genera.
     with st.chat_message("assistant"):
+        response_placeholder = st.empty()
         with st.spinner("Buscando y generando respuesta..."):
             try:
-                response = requests.post(
-                    "http://localhost:5000/ask",
+                assistant_response = ""
+                sources = []
+                stream_error = None
+                # El bloque `with` cierra la respuesta y devuelve la conexión a la sesión compartida
+                # aunque la lectura del stream falle a mitad.
+                with get_session().post(
+                    "http://localhost:5000/ask_stream",
                     json={"question": prompt},
-                    timeout=120
-                )
-                response.raise_for_status()
-                data = response.json()
-
-                if "answer" in data:
-                    assistant_response = data["answer"]
-                    sources = data.get("sources", [])
+                    timeout=120,
+                    stream=True
+                ) as response:
+                    if not response.ok:
+                        stream_error = backend_error_message(response)
+                    else:
+                        for line in response.iter_lines():
+                            # Cada evento llega en una línea con el formato "data: {...}"
+                            if not line or not line.startswith(b"data: "):
+                                continue
+                            event_line = line.decode("utf-8")
+                            event = json.loads(event_line[len("data: "):])
+                            if "delta" in event:
+                                assistant_response += event["delta"]
+                                response_placeholder.markdown(assistant_response + "▌")
+                            elif "sources" in event:
+                                sources = event["sources"]
+                            elif "error" in event:
+                                stream_error = event["error"]
 
-                    # Mostrar la respuesta del asistente
-                    st.markdown(assistant_response)
+                if stream_error is None:
+                    # Mostrar la respuesta completa del asistente
+                    response_placeholder.markdown(assistant_response)
                     if sources:
                         st.caption(f"Fuentes: {', '.join(sources)}")
 
@@ -72,15 +114,12 @@ if prompt := st.chat_input("Escribe tu pregunta aquí..."):
                         "content": assistant_response,
                         "sources": sources
                     })
-                elif "error" in data:
-                    error_message = f"Error del asistente: {data['error']}"
+                else:
+                    # Quitar el texto parcial (con el cursor) antes de mostrar el error.
+                    response_placeholder.empty()
+                    error_message = f"Error del asistente: {stream_error}"
                     st.error(error_message)
                     st.session_state.messages.append({"role": "assistant", "content": error_message})
-                else:
-                    unexpected_response_message = "Respuesta inesperada del servidor. Formato de datos incorrecto."
-                    st.error(unexpected_response_message)
-                    st.json(data)
-                    st.session_state.messages.append({"role": "assistant", "content": unexpected_response_message})
 
             except requests.exceptions.ConnectionError:
                 conn_error_message = (
@@ -101,7 +140,7 @@ if prompt := st.chat_input("Escribe tu pregunta aquí..."):
             except json.JSONDecodeError:
                 json_error_message = "❌ Error al decodificar la respuesta JSON del servidor. El backend pudo haber enviado una respuesta no JSON."
                 st.error(json_error_message)
-                st.write(f"Respuesta cruda: {response.text}")
+                st.write(f"Respuesta cruda: {event_line}")
                 st.session_state.messages.append({"role": "assistant", "content": json_error_message})
             except Exception as e:
                 generic_error_message = f"Ocurrió un error inesperado: {e}"
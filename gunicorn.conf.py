@@ -0,0 +1,23 @@
+# gunicorn.conf.py
+# Configuración de gunicorn para ejecutar el backend Flask en producción (Linux/macOS).
+# Uso: gunicorn -c gunicorn.conf.py backend_app:app
+
+import os
+
+bind = "127.0.0.1:5000"
+
+# Las llamadas a Ollama bloquean esperando E/S, por lo que los workers con hilos (gthread)
+# son la opción adecuada: cada hilo es barato mientras espera al servidor de modelos.
+# Con la base de datos Chroma local (sin CHROMA_HOST) solo puede haber un proceso abriendo
+# ./chroma_db: Chroma no admite varios procesos sobre el mismo directorio persistente.
+# Con un servidor de Chroma compartido se pueden usar varios workers.
+worker_class = "gthread"
+workers = 4 if os.getenv("CHROMA_HOST") else 1
+threads = 8
+
+# Generar una respuesta con el LLM puede tardar bastante; se evita que gunicorn mate al worker.
+timeout = 300
+
+# Cada worker importa backend_app por su cuenta y abre su propio cliente de Chroma.
+# No se usa preload_app: la conexión SQLite de Chroma no debe compartirse entre procesos vía fork.
+preload_app = False